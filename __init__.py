@@ -18,7 +18,15 @@
 # 02110-1301, USA.
 
 
+import functools
+import logging
 import re
+import sys
+
+try:
+    import re2
+except ImportError:
+    re2 = None
 
 from picard.metadata import MULTI_VALUED_JOINER
 from picard.plugin3.api import (
@@ -34,24 +42,158 @@ from .ui_options_genre_mapper import (
 
 USER_GUIDE_URL = 'https://picard-plugins-user-guides.readthedocs.io/en/latest/genre_mapper/user_guide.html'
 
-pairs_split = re.compile(r"\r\n|\n\r|\n").split
-
 OPT_GENRE_SEPARATOR = 'join_genres'
 OPT_MATCH_ENABLED = 'genre_mapper_enabled'
 OPT_MATCH_PAIRS = 'genre_mapper_replacement_pairs'
 OPT_MATCH_FIRST = 'genre_mapper_apply_first_match_only'
 OPT_MATCH_REGEX = 'genre_mapper_use_regex'
 
+PAIR_LITERAL = 'literal'
+PAIR_WILDCARD = 'wildcard'
+PAIR_REGEX = 'regex'
+
+# Characters with a special meaning in the simple (non-RegEx) translation
+SPECIAL_CHARACTERS = frozenset('*?^$.\\[](){}+|')
+
+# Numbered group references, which are not valid once a pattern is included in a combined pattern
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?\(\d')
+
+# Character classes and word boundaries that are Unicode aware in the re module but only match ASCII in RE2
+UNICODE_CLASSES = re.compile(r'\\[wWdDsSbB]')
+
+WILDCARD_TRANSLATION = str.maketrans({
+    '*': '.*',
+    '?': '.',
+    '.': '\\.',
+    '^': '\\^',
+    '$': '\\$',
+})
+
+
+def _fold_case(text):
+    # Case-folded key that compares the same way as re.IGNORECASE, or None if folding changes the length of the
+    # text (e.g.: 'ß' to 'ss'), which re.IGNORECASE does not treat as equal.  re.IGNORECASE also matches the
+    # dotless 'ı' with 'I', which case folding keeps distinct.
+    folded = text.casefold()
+    if len(folded) != len(text):
+        return None
+    return folded.replace('ı', 'i')
+
+
+def _can_fuse(pattern):
+    return (
+        isinstance(pattern, re.Pattern)
+        and not pattern.flags & ~(re.IGNORECASE | re.UNICODE)
+        and not GROUP_REFERENCE.search(pattern.pattern)
+    )
+
 
 class GenreMappingPairs:
     pairs = []
+    literals = {}
+    combined_match = None
+    combined_index = {}
+    combined_first = 0
+    fused = True
+    version = 0
 
     @classmethod
     def set_pairs(cls, new_pairs):
         cls.pairs = new_pairs
+        cls.version += 1
+
+        # Literal tests are matched with a single dictionary lookup, keeping the first occurrence of each test
+        cls.literals = {}
+        patterns = []
+        for index, (kind, test, _replacement, _replacement_title) in enumerate(new_pairs):
+            if kind == PAIR_LITERAL:
+                cls.literals.setdefault(test, index)
+            else:
+                patterns.append((index, kind, test))
+        cls.combined_index = {'_pair{0}'.format(index): index for (index, _kind, _pattern) in patterns}
+        cls.combined_first = patterns[0][0] if patterns else 0
+
+        # Fuse the patterns into a single alternation to find the first matching pair with one call.  Each
+        # branch is a named group, so the matching pair is found from the name of the last group matched.
+        # Patterns referring to groups by number cannot be fused since the group numbers are shifted, patterns
+        # with global inline flags (e.g.: '(?x)') cannot be fused since the flags would apply to every branch,
+        # and patterns compiled by RE2 are not fused so that they are never matched by the backtracking engine.
+        cls.combined_match = None
+        if patterns and all(_can_fuse(pattern) for (_index, _kind, pattern) in patterns):
+            # Regular expressions are tested using search(), so allow those branches to skip leading characters,
+            # while wildcard tests must match up to the end of the string.
+            branches = {
+                PAIR_WILDCARD: '(?P<_pair{0}>(?:{1})\\Z)',
+                PAIR_REGEX: '(?P<_pair{0}>(?s:.*?)(?:{1}))',
+            }
+            try:
+                combined = re.compile('|'.join(branches[kind].format(index, pattern.pattern) for (index, kind, pattern) in patterns), re.IGNORECASE)
+            except (re.error, ValueError, OverflowError):
+                # e.g.: duplicate group names
+                pass
+            else:
+                cls.combined_match = combined.match
+        cls.fused = cls.combined_match is not None or not patterns
+
+
+@functools.lru_cache(maxsize=4096)
+def _map_genre(genre, first_only, pairs_version):
+    # The pairs version is only used to invalidate the cached results when the pairs are refreshed
+    if not genre:
+        return genre
+
+    # Literal tests are already case-folded, so the genre only needs to be folded once.  A genre that cannot be
+    # folded (None) never matches a literal test.
+    genre_cf = _fold_case(genre)
+    pairs = GenreMappingPairs.pairs
+    if first_only and GenreMappingPairs.fused:
+        combined_match = GenreMappingPairs.combined_match
+        index = GenreMappingPairs.literals.get(genre_cf, len(pairs))
+        if combined_match is not None and GenreMappingPairs.combined_first < index:
+            match = combined_match(genre)
+            if match:
+                index = min(index, GenreMappingPairs.combined_index[match.lastgroup])
+        if index < len(pairs):
+            return pairs[index][3]
+        return sys.intern(genre.title())
+
+    # Later pairs are tested against the replacement as entered, while the result uses the title-cased copy
+    # prepared when the pairs were refreshed, so only unmatched genres need to be converted
+    result = None
+    for (kind, test, replacement, replacement_title) in pairs:
+        if not genre:
+            break
+        if kind == PAIR_LITERAL:
+            found = genre_cf == test
+        elif kind == PAIR_WILDCARD:
+            found = test.fullmatch(genre)
+        else:
+            found = test.search(genre)
+        if found:
+            genre = replacement
+            genre_cf = _fold_case(genre)
+            result = replacement_title
+            if first_only:
+                break
+    return result if result is not None else sys.intern(genre.title())
+
+
+@functools.lru_cache(maxsize=1024)
+def _map_genres(metadata_genres, first_only, pairs_version):
+    # Tracks on an album usually share the same list of genres, so the complete result is cached as well.
+    # Duplicates are removed keeping the genres in the order they were first found.
+    mapped = (_map_genre(genre, first_only, pairs_version) for genre in metadata_genres)
+    return tuple(dict.fromkeys(genre for genre in mapped if genre))
+
+
+def _noop(*args, **kwargs):
+    return None
 
 
 class GenreMapper:
+    # Shared by all instances so that refreshing from the options page updates the registered processor
+    _active_processor = _noop
+
     def __init__(self, api: PluginApi):
         self.api = api
 
@@ -62,26 +204,49 @@ class GenreMapper:
         )
         if self.api.plugin_config[OPT_MATCH_PAIRS] is None:
             self.api.logger.warning("Unable to read the '%s' setting.", OPT_MATCH_PAIRS,)
+            # Skip processing entirely rather than continuing with pairs from a previous refresh
+            GenreMappingPairs.set_pairs([])
+            GenreMapper._active_processor = _noop
             return
 
         def _make_re(map_string):
-            # Replace period with temporary placeholder character (newline)
-            re_string = str(map_string).strip().replace('.', '\n')
-
-            # Convert wildcard characters to regular expression equivalents
-            re_string = re_string.replace('*', '.*').replace('?', '.')
-
-            # Escape carat and dollar sign for regular expression
-            re_string = re_string.replace('^', '\\^').replace('$', '\\$')
-
-            # Replace temporary placeholder characters with escaped periods
-            re_string = '^' + re_string.replace('\n', '\\.') + '$'
-
-            # Return regular expression with carat and dollar sign to force match condition on full string
-            return re_string
-
+            map_string = str(map_string).strip()
+
+            # Tests without wildcards or other special characters are matched as case-folded strings, unless
+            # folding would change the test so that it no longer compares like re.IGNORECASE
+            if not any(c in SPECIAL_CHARACTERS for c in map_string):
+                folded = _fold_case(map_string)
+                if folded is not None:
+                    return PAIR_LITERAL, folded
+
+            # Convert wildcard characters to regular expression equivalents and escape periods, carats and
+            # dollar signs in a single pass
+            re_string = map_string.translate(WILDCARD_TRANSLATION)
+
+            # A '|' splits the test into alternatives, and was previously only anchored at the start of the
+            # first alternative and the end of the last one, so keep that behavior by searching within the genre
+            if '|' in re_string:
+                return PAIR_REGEX, re.compile('^' + re_string + '$', re.IGNORECASE)
+
+            # Wildcard tests are matched against the full string using fullmatch()
+            return PAIR_WILDCARD, re.compile(re_string, re.IGNORECASE)
+
+        def _compile_regex(re_string):
+            # Use the linear time RE2 engine for user supplied regular expressions if it is available, unless
+            # the expression relies on character classes that RE2 would match differently
+            if re2 is not None and not UNICODE_CLASSES.search(re_string):
+                try:
+                    return re2.compile('(?i)' + re_string)
+                except re2.error:
+                    pattern = re.compile(re_string, re.IGNORECASE)
+                    self.api.logger.warning('Regular expression not supported by RE2, using standard matching: "%s"', re_string,)
+                    return pattern
+            return re.compile(re_string, re.IGNORECASE)
+
+        use_regex = self.api.plugin_config[OPT_MATCH_REGEX]
+        log_debug = self.api.logger.isEnabledFor(logging.DEBUG)
         pairs = []
-        for pair in pairs_split(self.api.plugin_config[OPT_MATCH_PAIRS]):
+        for pair in self.api.plugin_config[OPT_MATCH_PAIRS].splitlines():
             if "=" not in pair:
                 continue
 
@@ -91,39 +256,44 @@ class GenreMapper:
                 continue
 
             replacement = replacement.strip()
-            pairs.append((original if self.api.plugin_config[OPT_MATCH_REGEX] else _make_re(original), replacement))
-            self.api.logger.debug('Add genre mapping pair: "%s" = "%s"', original, replacement,)
+            try:
+                kind, test = (PAIR_REGEX, _compile_regex(original)) if use_regex else _make_re(original)
+            except (re.error, ValueError, OverflowError):
+                # e.g.: incompatible flags (ValueError) or repeat counts that are too large (OverflowError)
+                self.api.logger.error('Invalid regular expression ignored: "%s"', original,)
+                continue
+            pairs.append((kind, test, replacement, sys.intern(replacement.title())))
+            if log_debug:
+                self.api.logger.debug('Add genre mapping pair: "%s" = "%s"', original, replacement,)
 
         GenreMappingPairs.set_pairs(pairs)
+        GenreMapper._active_processor = self._do_map if self.api.plugin_config[OPT_MATCH_ENABLED] and pairs else _noop
 
         if not pairs:
             self.api.logger.debug("No genre replacement maps defined.")
 
     def track_genre_mapper(self, api, album, metadata, *args):
-        if not self.api.plugin_config[OPT_MATCH_ENABLED]:
+        return GenreMapper._active_processor(api, album, metadata, *args)
+
+    def _do_map(self, api, album, metadata, *args):
+        # Use the stored values directly rather than joining and splitting them again
+        _getall = getattr(metadata, 'getall', None)
+        if _getall is not None:
+            metadata_genres = _getall('genre')
+        else:
+            metadata_genres = [metadata['genre']] if 'genre' in metadata else []
+        if len(metadata_genres) == 1:
+            # Genres may have been joined into a single value
+            metadata_genres = metadata_genres[0].split(self.api.plugin_config[OPT_GENRE_SEPARATOR] or MULTI_VALUED_JOINER)
+        log = self.api.logger
+        if not any(metadata_genres):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('No genres found for: "%s"', metadata['title'],)
             return
 
-        if 'genre' not in metadata or not metadata['genre']:
-            self.api.logger.debug('No genres found for: "%s"', metadata['title'],)
-            return
-
-        genre_joiner = self.api.plugin_config[OPT_GENRE_SEPARATOR] if self.api.plugin_config[OPT_GENRE_SEPARATOR] else MULTI_VALUED_JOINER
-        genres = set()
-        metadata_genres = str(metadata['genre']).split(genre_joiner)
-        for genre in metadata_genres:
-            for (original, replacement) in GenreMappingPairs.pairs:
-                try:
-                    if genre and re.search(original, genre, re.IGNORECASE):
-                        genre = replacement
-                        if self.api.plugin_config[OPT_MATCH_FIRST]:
-                            break
-                except re.error:
-                    self.api.logger.error('Invalid regular expression ignored: "%s"', original,)
-            if genre:
-                genres.add(genre.title())
-
-        genres = sorted(genres)
-        self.api.logger.debug('Genres updated from %s to %s', metadata_genres, genres,)
+        genres = list(_map_genres(tuple(metadata_genres), self.api.plugin_config[OPT_MATCH_FIRST], GenreMappingPairs.version))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Genres updated from %s to %s', metadata_genres, genres,)
         metadata['genre'] = genres
 
 